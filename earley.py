@@ -1,54 +1,269 @@
 #!/usr/bin/env python3
 
+import os
+from array import array
+from collections import deque
+from collections.abc import Sequence
+from multiprocessing import Pool
+
+# Items are packed into a single int: the start column occupies the low
+# START_BITS, the dot position the DOT_BITS above it and the rule id the rest.
+START_BITS = 32
+DOT_BITS   = 16
+RULE_SHIFT = START_BITS + DOT_BITS
+START_MASK = (1 << START_BITS) - 1
+DOT_MASK   = (1 << DOT_BITS) - 1
+DOT_ONE    = 1 << START_BITS
+# items are stored in signed 64 bit arrays, which leaves 63 - RULE_SHIFT bits
+# for the rule id
+MAX_RULES  = 1 << 63 - RULE_SHIFT
+
+# Symbol kinds, as stored in Grammar.symbol_kind.
+TERMINAL    = 0
+NONTERMINAL = 1
+NULLABLE    = 2
+
+# Marks the end of each rule in Grammar.rhs_flat.
+END = -1
+
+def unpack_item(item):
+    return item >> RULE_SHIFT, item >> START_BITS & DOT_MASK, item & START_MASK
+
 class Grammar:
-    __slots__ = ('terminals', 'nonterminals', 'nullable')
+    __slots__ = (
+        'terminals', 'nonterminals', 'nullable', '_lookup',
+        'symbols', 'sym_id', 'num_terminals',
+        'lhs', 'rlen', 'rhs_off', 'rhs_flat', 'rule_objects',
+        'rules_for', 'symbol_kind', 'nonnull_after', 'predict_closure',
+        'predict_symbols', 'predicates', 'terminal_mask', 'untabulated',
+        'recognizer',
+    )
 
     def __init__(self, terminals, nonterminals):
         self.terminals = terminals
         self.nonterminals = nonterminals
+        self._lookup = dict(nonterminals)
+        self._lookup.update(terminals)
         self.nullable = self.get_nullable_rules()
+        self.encode()
+        self.recognizer = None
+
+    def __getstate__(self):
+        """ Pickle everything but the compiled recognizer, which is generated again on first use. """
+        return {name: getattr(self, name) for name in self.__slots__ if name != 'recognizer'}
+
+    def __setstate__(self, state):
+        for name, value in state.items():
+            setattr(self, name, value)
+        self.recognizer = None
 
     def __getitem__(self, symbol):
-        try:
-            return self.terminals[symbol]
-        except KeyError:
-            return self.nonterminals[symbol]
+        return self._lookup[symbol]
 
     def __contains__(self, symbol):
-        return symbol in self.terminals or symbol in self.nonterminals
+        return symbol in self._lookup
 
     def get_nullable_rules(self):
-        """ Find all nullable symbols in the grammar. """
-        nss = set()
-        def is_nullable(rule):
-            return all(x in nss for x in rule)
+        """ Find all nullable symbols in the grammar. Each rule is queued again only when one of the symbols it mentions becomes nullable. """
+        uses = {}
+        for s, rules in self.nonterminals.items():
+            for rule in rules:
+                for x in set(rule):
+                    uses.setdefault(x, []).append((s, rule))
 
-        def update_nss():
-            for s, rules in self.nonterminals.items():
-                if any(map(is_nullable, rules)):
-                    nss.add(s)
-
-        while True:
-            size = len(nss)
-            update_nss()
-            if size == len(nss):
-                break
+        nss = set()
+        queue = deque(
+            (s, rule)
+            for s, rules in self.nonterminals.items()
+            for rule in rules
+            if rule.rlen == 0
+        )
+        while queue:
+            s, rule = queue.popleft()
+            if s not in nss and all(x in nss for x in rule):
+                nss.add(s)
+                queue.extend(uses.get(s, ()))
         return nss
 
+    def encode(self):
+        """ Assign integer ids to symbols and rules. Terminals come first, then nonterminals, then symbols that are referenced but never defined, which have no rules. Raise ValueError if the grammar does not fit the packed item layout: more than MAX_RULES distinct rules, or a rule longer than DOT_MASK symbols. """
+        self.symbols = list(self.terminals)
+        self.sym_id = {s: i for i, s in enumerate(self.symbols)}
+        self.num_terminals = len(self.symbols)
+
+        def intern(symbol):
+            if symbol not in self.sym_id:
+                self.sym_id[symbol] = len(self.symbols)
+                self.symbols.append(symbol)
+            return self.sym_id[symbol]
+
+        for symbol in self.nonterminals:
+            intern(symbol)
+
+        # rules are stored as parallel arrays; the right hand side of rule r
+        # is rhs_flat[rhs_off[r]:rhs_off[r] + rlen[r]] followed by END. Equal
+        # rules share one id, so their items deduplicate like equal Items.
+        self.lhs = array('i')
+        self.rlen = array('i')
+        self.rhs_off = array('i')
+        self.rhs_flat = array('i')
+        self.rule_objects = []
+        self.rules_for = {}
+        rule_ids = {}
+        for symbol, rules in self.nonterminals.items():
+            ids = self.rules_for.setdefault(self.sym_id[symbol], [])
+            for rule in rules:
+                if rule in rule_ids:
+                    if rule_ids[rule] not in ids:
+                        ids.append(rule_ids[rule])
+                    continue
+                if rule.rlen > DOT_MASK:
+                    raise ValueError(f'rule for {rule.symbol!r} has {rule.rlen} symbols, at most {DOT_MASK} are supported')
+                if len(self.rule_objects) == MAX_RULES:
+                    raise ValueError(f'grammar has more than {MAX_RULES} distinct rules')
+                rule_ids[rule] = len(self.rule_objects)
+                ids.append(len(self.rule_objects))
+                self.lhs.append(intern(rule.symbol))
+                self.rlen.append(rule.rlen)
+                self.rhs_off.append(len(self.rhs_flat))
+                self.rhs_flat.extend(map(intern, rule.seq))
+                self.rhs_flat.append(END)
+                self.rule_objects.append(rule)
+        self.rules_for = [self.rules_for.get(i, []) for i in range(len(self.symbols))]
+
+        self.symbol_kind = bytes(
+            TERMINAL if i < self.num_terminals else
+            NULLABLE if s in self.nullable else
+            NONTERMINAL
+            for i, s in enumerate(self.symbols)
+        )
+
+        # same layout as rhs_flat, holding the first non-nullable dot position
+        self.nonnull_after = array('i', [0]) * len(self.rhs_flat)
+        for rule_id, off in enumerate(self.rhs_off):
+            stop = self.rlen[rule_id]
+            self.nonnull_after[off + stop] = stop
+            for dot in reversed(range(stop)):
+                if self.symbol_kind[self.rhs_flat[off + dot]] != NULLABLE:
+                    stop = dot
+                self.nonnull_after[off + dot] = stop
+
+        self.predict_closure = []
+        self.predict_symbols = []
+        for symbol in range(len(self.symbols)):
+            symbols = self.left_corners(symbol)
+            self.predict_symbols.append(frozenset(symbols))
+            self.predict_closure.append(tuple(r for s in symbols for r in self.rules_for[s]))
+
+        self.predicates = [self.terminals[s] for s in self.symbols[:self.num_terminals]]
+
+        # token masks of the first 256 characters, sampled from the predicates.
+        # A terminal whose predicate raises on any of them is left out of the
+        # table and marked in untabulated, so it is tested on each token instead
+        self.terminal_mask = [0] * 256
+        self.untabulated = 0
+        for t, predicate in enumerate(self.predicates):
+            try:
+                accepted = [c for c in range(256) if predicate(chr(c))]
+            except Exception:
+                self.untabulated |= 1 << t
+                continue
+            for c in accepted:
+                self.terminal_mask[c] |= 1 << t
+
+    def compile(self):
+        """ Return a recognizer specialized for this grammar, generated from RECOGNIZER on first use. It takes the input as a sequence of tokens and returns the state sets. """
+        if self.recognizer is None:
+            constants = {
+                'RULE_SHIFT': RULE_SHIFT,
+                'START_BITS': START_BITS,
+                'START_MASK': START_MASK,
+                'DOT_MASK': DOT_MASK,
+                'DOT_ONE': DOT_ONE,
+                'END': END,
+            }
+            nullable = [s for s, kind in enumerate(self.symbol_kind) if kind == NULLABLE]
+            nullable_completion = ''
+            if nullable:
+                nullable_completion = NULLABLE_COMPLETION.format(
+                    nullable=', '.join(map(str, nullable)), **constants)
+            source = RECOGNIZER.format(
+                start_symbol=self.sym_id[next(iter(self.nonterminals))],
+                num_terminals=self.num_terminals,
+                nullable_completion=nullable_completion,
+                **constants
+            )
+
+            namespace = {
+                'lhs': self.lhs,
+                'rhs_flat': self.rhs_flat,
+                'rhs_off': self.rhs_off,
+                'predict_closure': self.predict_closure,
+                'predict_symbols': self.predict_symbols,
+                'nonnull_after': self.nonnull_after,
+                'StateSet': StateSet,
+                'get_topmost': get_topmost,
+                'predicates': self.predicates,
+                'mask_of': self.token_mask,
+            }
+            exec(compile(source, '<earley recognizer>', 'exec'), namespace)
+            self.recognizer = namespace['recognize']
+        return self.recognizer
+
+    def left_corners(self, symbol):
+        """ Return the nonterminals that get predicted, directly or transitively, when symbol is predicted, starting with symbol itself. A symbol is a left corner of a rule if only nullable symbols precede it. """
+        if self.symbol_kind[symbol] == TERMINAL:
+            return []
+        corners = [symbol]
+        seen = {symbol}
+        for s in corners:
+            for rule_id in self.rules_for[s]:
+                pos = self.rhs_off[rule_id]
+                while self.rhs_flat[pos] != END:
+                    x = self.rhs_flat[pos]
+                    kind = self.symbol_kind[x]
+                    if kind != TERMINAL and x not in seen:
+                        seen.add(x)
+                        corners.append(x)
+                    if kind != NULLABLE:
+                        break
+                    pos += 1
+        return corners
+
+    def token_mask(self, token):
+        """ Return the pair (tested, matched) of bitmasks of the terminal ids whose predicates are already known for token, and of those among them that accept it. Single characters below U+0100 are looked up in terminal_mask for every terminal but the untabulated ones, other tokens start with nothing tested. """
+        if type(token) is str and len(token) == 1 and token < '\u0100':
+            return ~self.untabulated, self.terminal_mask[ord(token)]
+        return 0, 0
+
+    def next_symbol(self, item):
+        """ Return the id of the symbol after the dot of a packed item, or None if the item is complete. """
+        symbol = self.rhs_flat[self.rhs_off[item >> RULE_SHIFT] + (item >> START_BITS & DOT_MASK)]
+        return None if symbol == END else symbol
+
+    def item(self, item):
+        """ Decode a packed item into an Item. """
+        rule_id, dot, start = unpack_item(item)
+        return Item(self.rule_objects[rule_id], dot, start)
+
 class Rule:
-    __slots__ = ('symbol', 'seq')
+    __slots__ = ('symbol', 'seq', 'rlen')
 
     def __init__(self, symbol, seq):
         self.symbol = symbol
-        self.seq = seq
+        self.seq = tuple(seq)
+        self.rlen = len(self.seq)
 
     def __eq__(self, other):
         return \
             self.symbol == other.symbol and \
             self.seq == other.seq
 
+    def __hash__(self):
+        return hash((self.symbol, self.seq))
+
     def __len__(self):
-        return len(self.seq)
+        return self.rlen
 
     def __getitem__(self, index):
         return self.seq[index]
@@ -57,6 +272,16 @@ class Rule:
         s = ' '.join(self.seq)
         return f'[{self.symbol} -> {s}]'
 
+class Chars:
+    """ Terminal predicate accepting any of the given characters. Unlike a lambda it can be pickled, so grammars built from it can be sent to worker processes. """
+    __slots__ = ('chars',)
+
+    def __init__(self, chars):
+        self.chars = frozenset(chars)
+
+    def __call__(self, token):
+        return token in self.chars
+
 class Item:
     __slots__ = ('rule', 'dot', 'start')
 
@@ -67,129 +292,263 @@ class Item:
 
     def __eq__(self, other):
         return \
-            self.rule  == other.rule and \
+            self.rule == other.rule and \
             self.dot == other.dot and \
             self.start == other.start
 
+    def __hash__(self):
+        return hash((self.rule, self.dot, self.start))
+
     def __repr__(self):
         seq = list(self.rule.seq)
         seq.insert(self.dot, '•')
         seq = ' '.join(seq)
         return f'[{self.rule.symbol} -> {seq} ({self.start})]'
 
-    @classmethod
-    def advance(cls, item):
-        return cls(item.rule, item.dot + 1, item.start)
-
-def get_topmost(statesets, item):
-    """ Given [A -> a. (i)] "item" search for [X -> b.A (j)] in S(i) "match" such that match is the only item in S(i) with A after the dot. Instead of doing a completion and adding [X -> bA. (j)] "result" we repeat the search on result. If no match is found for a given item, we just return that item. """
-    while True:
-        found    = False
-        match    = None
-        stateset = statesets[item.start]
-        for m in stateset:
-            if m.dot < len(m.rule) and m.rule[m.dot] == item.rule.symbol:
-                if match:
-                    return item
-                match = m
-                if m.dot == len(m.rule) - 1:
-                    found = True
-
-        if found and match:
-            item = Item.advance(match)
+class StateSet:
+    __slots__ = ('rhs_flat', 'rhs_off', 'items', 'entries', 'by_next_symbol', 'leo_cache')
+
+    def __init__(self, rhs_flat, rhs_off):
+        self.rhs_flat = rhs_flat
+        self.rhs_off = rhs_off
+        self.items = array('q')
+        # the starts of the items in the set, keyed by core, the rule id and
+        # dot part of a packed item (item >> START_BITS). A single start is
+        # stored as a plain int and becomes a set when a second one arrives.
+        self.entries = {}
+        self.by_next_symbol = {}
+        self.leo_cache = {}
+
+    def add(self, item):
+        """ Append a packed item unless it is already present. """
+        core = item >> START_BITS
+        start = item & START_MASK
+        starts = self.entries.get(core)
+        if starts is None:
+            self.entries[core] = start
+            self.index(core, item + DOT_ONE)
+        elif type(starts) is int:
+            if starts == start:
+                return
+            self.entries[core] = {starts, start}
+            self.invalidate(core)
+        elif start in starts:
+            return
         else:
-            return item
+            starts.add(start)
+        self.items.append(item)
+
+    def add_starts(self, core, starts):
+        """ Append the packed items with the given core for every start in the set starts that is not already present. """
+        existing = self.entries.get(core)
+        if existing is None:
+            new = self.entries[core] = set(starts)
+            self.index(core, None)
+        elif type(existing) is int:
+            new = starts - {existing}
+            self.entries[core] = starts | {existing}
+            self.invalidate(core)
+        else:
+            new = starts - existing
+            existing |= new
+        core <<= START_BITS
+        for start in new:
+            self.items.append(core | start)
+
+    def index(self, core, advanced):
+        """ Index a new core by the symbol after its dot. For each such symbol leo_cache holds the advanced item if exactly one item has the symbol after its dot and that symbol ends its rule, and None otherwise. advanced is the advanced item if the core has a single start, and None otherwise. """
+        pos = self.rhs_off[core >> DOT_BITS] + (core & DOT_MASK)
+        symbol = self.rhs_flat[pos]
+        if symbol != END:
+            cores = self.by_next_symbol.get(symbol)
+            if cores is None:
+                self.by_next_symbol[symbol] = [core]
+                self.leo_cache[symbol] = advanced if self.rhs_flat[pos + 1] == END else None
+            else:
+                cores.append(core)
+                self.leo_cache[symbol] = None
+
+    def invalidate(self, core):
+        """ Clear the leo_cache entry for the symbol after the dot of a core that just got a second start. """
+        symbol = self.rhs_flat[self.rhs_off[core >> DOT_BITS] + (core & DOT_MASK)]
+        if symbol != END:
+            self.leo_cache[symbol] = None
+
+    def __contains__(self, item):
+        starts = self.entries.get(item >> START_BITS)
+        if type(starts) is int:
+            return starts == item & START_MASK
+        return starts is not None and item & START_MASK in starts
+
+    def __iter__(self):
+        return iter(self.items)
 
-def earley(grammar, string):
-    statesets = [[]]
+    def __len__(self):
+        return len(self.items)
 
-    symbol = list(grammar.nonterminals.keys())[0]
-    for rule in grammar[symbol]:
-        statesets[-1].append(Item(rule, 0, 0))
+def get_topmost(lhs, statesets, item):
+    """ Given [A -> a. (i)] "item" search for [X -> b.A (j)] in S(i) "match" such that match is the only item in S(i) with A after the dot. Instead of doing a completion and adding [X -> bA. (j)] "result" we repeat the search on result. If no match is found for a given item, we just return that item. The search is a lookup in the leo_cache of S(i). """
+    while True:
+        topmost = statesets[item & START_MASK].leo_cache.get(lhs[item >> RULE_SHIFT])
+        if topmost is None:
+            return item
+        item = topmost
+
+# Source of the recognizer that Grammar.compile() specializes for a grammar.
+# The grammar tables are bound as default arguments, and the start symbol,
+# the terminal id range, the nullable symbols and the item layout are inlined
+# as constants. Nullable completion is left out if nothing is nullable.
+RECOGNIZER = """
+def recognize(tokens, lhs=lhs, rhs_flat=rhs_flat, rhs_off=rhs_off,
+              predict_closure=predict_closure, predict_symbols=predict_symbols,
+              nonnull_after=nonnull_after, StateSet=StateSet, get_topmost=get_topmost,
+              predicates=predicates, mask_of=mask_of):
+    n = len(tokens)
+    statesets = [StateSet(rhs_flat, rhs_off)]
+
+    for rule_id in predict_closure[{start_symbol}]:
+        statesets[0].add(rule_id << {RULE_SHIFT})
 
     i = 0
-    while i < len(statesets):
+    while i <= n:
         stateset = statesets[i]
+        items = stateset.items
+        if not items:
+            # nothing can be scanned into the following columns
+            break
+        add = stateset.add
+        add_starts = stateset.add_starts
+        predicted = set(predict_symbols[{start_symbol}]) if i == 0 else set()
+        if i < n:
+            token = tokens[i]
+            tested, matched = mask_of(token)
+            following = StateSet(rhs_flat, rhs_off)
+            statesets.append(following)
+            scan = following.add
+        else:
+            tested, matched = -1, 0
 
+        # items only grows while the column is processed, so its length is
+        # read again only once j catches up with the last known size
         j = 0
-        while j < len(stateset):
-            item = stateset[j]
-            rule = item.rule
-
-            if item.dot == len(rule):
+        size = len(items)
+        while True:
+            if j == size:
+                size = len(items)
+                if j == size:
+                    break
+            item = items[j]
+            rule_id = item >> {RULE_SHIFT}
+            dot = item >> {START_BITS} & {DOT_MASK}
+            pos = rhs_off[rule_id] + dot
+            symbol = rhs_flat[pos]
+
+            if symbol == {END}:
                 # search for the topmost item in the deterministic reduction
                 # path and add it instead if it exists
-                topmost = get_topmost(statesets, item)
+                topmost = get_topmost(lhs, statesets, item)
                 if topmost != item:
-                    if topmost not in statesets[i]:
-                        statesets[i].append(topmost)
+                    add(topmost)
                 else:
-                    for x in statesets[item.start]:
-                        if x.dot < len(x.rule) and x.rule[x.dot] == item.rule.symbol:
-                            newitem = Item.advance(x)
-                            if newitem not in stateset:
-                                stateset.append(newitem)
-
-            elif rule[item.dot] in grammar.terminals and i < len(string):
-                # scan
-                symbol = rule[item.dot]
-                token = string[i]
-                if grammar.terminals[symbol](token):
-                    newitem = Item.advance(item)
-                    if i == len(statesets) - 1:
-                        statesets.append([])
-                    statesets[i + 1].append(newitem)
-
-            elif rule[item.dot] in grammar.nonterminals:
+                    origin = statesets[item & {START_MASK}]
+                    origin_entries = origin.entries
+                    for core in origin.by_next_symbol.get(lhs[rule_id], ()):
+                        starts = origin_entries[core]
+                        if type(starts) is int:
+                            add(core + 1 << {START_BITS} | starts)
+                        else:
+                            add_starts(core + 1, starts)
+
+            elif symbol < {num_terminals}:
+                # scan, calling the predicate of a terminal only the first
+                # time the terminal is expected in the column
+                if not tested >> symbol & 1:
+                    tested |= 1 << symbol
+                    if predicates[symbol](token):
+                        matched |= 1 << symbol
+                if matched >> symbol & 1:
+                    scan(item + {DOT_ONE})
+
+            else:
                 # prediction
-                symbol = rule[item.dot]
-                for rule in grammar[symbol]:
-                    newitem = Item(rule, 0, i)
-                    if newitem not in stateset:
-                        stateset.append(newitem)
-
-                # automatic completion for nullable symbols
-                if symbol in grammar.nullable:
-                    newitem = Item.advance(item)
-                    if newitem not in statesets[i]:
-                        statesets[i].append(newitem)
-
+                if symbol not in predicted:
+                    predicted.update(predict_symbols[symbol])
+                    for rule_id in predict_closure[symbol]:
+                        add(rule_id << {RULE_SHIFT} | i)
+{nullable_completion}
             j += 1
         i += 1
 
     return statesets
+"""
+
+NULLABLE_COMPLETION = """
+                # automatic completion for nullable symbols, advancing
+                # past every nullable symbol that follows in one go
+                if symbol in {{{nullable}}}:
+                    newitem = item
+                    for _ in range(dot, nonnull_after[pos + 1]):
+                        newitem += {DOT_ONE}
+                        add(newitem)
+"""
 
-def dump_statesets(statesets):
+def earley(grammar, string):
+    """ Run the recognizer on string, a sequence or iterable of at most START_MASK tokens. A terminal predicate is only called on a token if the terminal is expected in its column, and at most once per column. Single characters below U+0100 are looked up instead in the table sampled when the grammar was built, for every terminal whose predicate did not raise while being sampled. """
+    if not isinstance(string, Sequence):
+        string = list(string)
+    if len(string) > START_MASK:
+        raise ValueError(f'input has {len(string)} tokens, at most {START_MASK} are supported')
+    return grammar.compile()(string)
+
+def dump_statesets(grammar, statesets):
     for i, s in enumerate(statesets):
         print(f'=== S({i}) ===')
         for i, x in enumerate(s):
-            print(f'{i}: {x}')
+            print(f'{i}: {grammar.item(x)}')
         print()
 
     print('=== COMPLETED ===')
     for i, x in enumerate(statesets[-1]):
-        if x.dot == len(x.rule) and x.start == 0:
-            print(f'{i}: {x}')
+        if grammar.next_symbol(x) is None and x & START_MASK == 0:
+            print(f'{i}: {grammar.item(x)}')
 
-def completed_items(stateset):
-    for x in stateset[-1]:
-        if x.dot == len(x.rule) and x.start == 0:
-            yield x
+def completed_items(grammar, statesets):
+    for x in statesets[-1]:
+        if grammar.next_symbol(x) is None and x & START_MASK == 0:
+            yield grammar.item(x)
 
 def is_valid_parse(grammar, string):
     stateset = earley(grammar, string)
-    return \
-        len(stateset) == len(string) + 1 and \
-        len(list(completed_items(stateset))) == 1
+    return len(list(completed_items(grammar, stateset))) == 1
+
+# grammar of the current is_valid_parse_batch worker process
+worker_grammar = None
+
+def init_worker(grammar):
+    global worker_grammar
+    worker_grammar = grammar
+
+def is_valid_worker_parse(string):
+    return is_valid_parse(worker_grammar, string)
+
+def is_valid_parse_batch(grammar, strings, processes=None):
+    """ Run is_valid_parse for each of strings in a pool of worker processes and return the results in order. At most processes workers are started, by default one per CPU, and never more than there are strings. The grammar is sent to each worker once, so it must be picklable: use module-level functions or Chars as terminal predicates rather than lambdas. """
+    strings = list(strings)
+    if not strings:
+        return []
+    processes = min(len(strings), processes or os.cpu_count() or 1)
+    chunksize = max(1, len(strings) // (4 * processes))
+    with Pool(processes, initializer=init_worker, initargs=(grammar,)) as pool:
+        return pool.map(is_valid_worker_parse, strings, chunksize=chunksize)
 
 def test_simple_arith():
     grammar = Grammar(
         {
-            '[+-]': lambda x: x in '+-',
-            '[*/]': lambda x: x in '*/',
-            '[0-9]': lambda x: x.isdecimal(),
-            '(': lambda x: x == '(',
-            ')': lambda x: x == ')',
+            '[+-]': Chars('+-'),
+            '[*/]': Chars('*/'),
+            '[0-9]': str.isdecimal,
+            '(': Chars('('),
+            ')': Chars(')'),
         },
         {
             'Sum': [
@@ -217,8 +576,7 @@ def test_simple_arith():
         '1+2',
         '1+(2*3-4)',
     ]
-    for string in positive:
-        assert is_valid_parse(grammar, string)
+    assert all(is_valid_parse_batch(grammar, positive))
 
     negative = [
         '',
@@ -228,8 +586,8 @@ def test_simple_arith():
         '2+(4*5))',
         '2++2',
     ]
-    for string in negative:
-        assert not is_valid_parse(grammar, string)
+    assert not any(is_valid_parse_batch(grammar, negative))
+    assert is_valid_parse_batch(grammar, []) == []
 
 def test_nullable():
     grammar1 = Grammar(
@@ -294,6 +652,143 @@ def test_nullable():
     for grammar, string in negative:
         assert not is_valid_parse(grammar, string)
 
+def test_duplicate_rules():
+    grammar = Grammar(
+        {
+            'b': lambda x: x == 'b',
+        },
+        {
+            'S': [
+                Rule('S', ['S', 'S']),
+                Rule('S', ['S', 'S']),
+                Rule('S', ['b']),
+            ],
+        }
+    )
+
+    assert is_valid_parse(grammar, 'bb')
+
+def test_ambiguous():
+    grammar = Grammar(
+        {
+            'a': lambda x: x == 'a',
+        },
+        {
+            'S': [
+                Rule('S', ['S', 'S']),
+                Rule('S', ['a']),
+                Rule('S', ['a', 'a']),
+            ],
+        }
+    )
+
+    # 'aa' has two derivations, so two completed items
+    positive = ['a', 'aaa', 'aaaa', 'aaaaa']
+    negative = ['', 'aa', 'ab']
+    for string in positive:
+        assert is_valid_parse(grammar, string)
+    for string in negative:
+        assert not is_valid_parse(grammar, string)
+
+    # items that differ only in their start share a core in the state set
+    expected = [
+        {'[S -> • S S (0)]', '[S -> • a (0)]', '[S -> • a a (0)]'},
+        {'[S -> S • S (0)]', '[S -> a • (0)]', '[S -> a • a (0)]',
+         '[S -> • S S (1)]', '[S -> • a (1)]', '[S -> • a a (1)]'},
+        {'[S -> S S • (0)]', '[S -> S • S (0)]', '[S -> S • S (1)]',
+         '[S -> a a • (0)]', '[S -> a • (1)]', '[S -> a • a (1)]',
+         '[S -> • S S (2)]', '[S -> • a (2)]', '[S -> • a a (2)]'},
+        {'[S -> S S • (0)]', '[S -> S S • (1)]', '[S -> S • S (0)]',
+         '[S -> S • S (1)]', '[S -> S • S (2)]', '[S -> a a • (1)]',
+         '[S -> a • (2)]', '[S -> a • a (2)]', '[S -> • S S (3)]',
+         '[S -> • a (3)]', '[S -> • a a (3)]'},
+    ]
+    statesets = earley(grammar, 'aaa')
+    assert len(statesets) == len(expected)
+    for stateset, items in zip(statesets, expected):
+        assert len(stateset) == len(items)
+        assert {repr(grammar.item(x)) for x in stateset} == items
+
+def test_layout_limits():
+    terminals = {
+        'a': lambda x: x == 'a',
+    }
+    too_long = {
+        'S': [
+            Rule('S', ['a'] * (DOT_MASK + 1)),
+        ],
+    }
+    too_many = {
+        'S': [Rule('S', [f'X{i}']) for i in range(MAX_RULES + 1)],
+    }
+    for nonterminals in too_long, too_many:
+        try:
+            Grammar(terminals, nonterminals)
+        except ValueError:
+            pass
+        else:
+            assert False, 'grammar does not fit the item layout'
+
+    # the longest supported rule still parses
+    grammar = Grammar(terminals, {'S': [Rule('S', ['a'] * DOT_MASK)]})
+    assert is_valid_parse(grammar, 'a' * DOT_MASK)
+    assert not is_valid_parse(grammar, 'a' * (DOT_MASK - 1))
+
+def test_raising_predicate():
+    grammar = Grammar(
+        {
+            'x': lambda x: x == 'x',
+            'small': lambda x: int(x) < 5,
+        },
+        {
+            'S': [
+                Rule('S', ['x', 'small']),
+            ],
+        }
+    )
+
+    # int() raises on most characters, so only 'small' is left untabulated
+    assert grammar.untabulated == 1 << grammar.sym_id['small']
+    assert grammar.terminal_mask[ord('x')] == 1 << grammar.sym_id['x']
+
+    assert is_valid_parse(grammar, 'x3')
+    assert not is_valid_parse(grammar, 'x7')
+    assert not is_valid_parse(grammar, '3x')
+
+def test_mixed_token_types():
+    grammar = Grammar(
+        {
+            'num': lambda x: x == 1,
+            'word': lambda x: x.isalpha(),
+        },
+        {
+            'S': [
+                Rule('S', ['num', 'word']),
+            ],
+        }
+    )
+
+    # 'word' must not be tried on the int, where isalpha does not exist
+    assert is_valid_parse(grammar, [1, 'x'])
+    assert not is_valid_parse(grammar, [1, 'xy1'])
+    assert not is_valid_parse(grammar, ['x', 1])
+
+def test_non_ascii_terminals():
+    grammar = Grammar(
+        {
+            'x': lambda x: x == 'x',
+            'λ': lambda x: x == 'λ',
+        },
+        {
+            'S': [
+                Rule('S', ['λ', 'x']),
+            ],
+        }
+    )
+
+    assert is_valid_parse(grammar, 'λx')
+    assert not is_valid_parse(grammar, 'xλ')
+
 def test_right_recursion_optimization():
     grammar = Grammar(
         {